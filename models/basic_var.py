@@ -1,4 +1,6 @@
 import math
+from contextlib import nullcontext
+from typing import Dict, Optional
 
 import torch
 import torch.nn as nn
@@ -7,12 +9,15 @@ import torch.nn.functional as F
 from models.helpers import DropPath, drop_path
 
 
-# this file only defines the 4 blocks used in VAR transformer
-__all__ = ['FFN', 'SelfAttention', 'SABlock', 'AdaLNSABlock',]
+# this file only defines the 4 blocks used in VAR transformer (and the kv cache state shared by their attention)
+__all__ = ['KVCacheState', 'FFN', 'SelfAttention', 'SABlock', 'AdaLNSABlock',]
 
 
 # automatically import faster operators
-dropout_add_layer_norm = fused_mlp_func = memory_efficient_attention = flash_attn_func = None
+dropout_add_layer_norm = fused_mlp_func = memory_efficient_attention = flash_attn_func = flash_attn_with_kvcache = sdpa_kernel = None
+flex_attention = create_block_mask = BlockMask = None
+ada_ln_modulate = gate_residual_ada_ln_modulate = None
+mark_static_address = None
 try:
     from flash_attn.ops.layer_norm import dropout_add_layer_norm
     from flash_attn.ops.fused_dense import fused_mlp_func
@@ -21,12 +26,52 @@ try: from xformers.ops import memory_efficient_attention
 except ImportError: pass
 try: from flash_attn import flash_attn_func              # qkv: BLHc, ret: BLHcq
 except ImportError: pass
+try: from flash_attn import flash_attn_with_kvcache      # flash-attn>=2.2; q: BLHc, kv cache: BLHc, ret: BLHc
+except ImportError: pass
+try: from models.fused_aln import ada_ln_modulate, gate_residual_ada_ln_modulate    # triton kernels, inference only
+except ImportError: pass
 try: from torch.nn.functional import scaled_dot_product_attention as slow_attn    # q, k, v: BHLc
 except ImportError:
     def slow_attn(query, key, value, scale: float, attn_mask=None, dropout_p=0.0):
         attn = query.mul(scale) @ key.transpose(-2, -1) # BHLc @ BHcL => BHLL
         if attn_mask is not None: attn.add_(attn_mask)
         return (F.dropout(attn.softmax(dim=-1), p=dropout_p, inplace=True) if dropout_p > 0 else attn.softmax(dim=-1)) @ value
+try:
+    from torch.nn.attention import SDPBackend, sdpa_kernel  # torch>=2.3
+    FUSED_SDPA_BACKENDS = [SDPBackend.FLASH_ATTENTION, SDPBackend.EFFICIENT_ATTENTION]  # never materialize the BHLL attention matrix
+except ImportError: pass
+try:
+    from torch.nn.attention.flex_attention import BlockMask, create_block_mask, flex_attention  # torch>=2.5; q, k, v: BHLc
+    flex_attention = torch.compile(flex_attention, dynamic=False)   # flex_attention is only fast when compiled
+except ImportError: pass
+try: from torch._dynamo import mark_static_address    # torch>=2.1; CUDA graphs use such a tensor in place instead of copying it in every replay
+except ImportError: pass
+
+
+class KVCacheState:
+    """
+    the kv cache state of one or more SelfAttention modules; VAR shares a single instance among all of its blocks,
+    so that turning caching on/off is one python call rather than `depth` ones.
+    with max_L > 0, each module keeps its k and v in a preallocated buffer (see `SelfAttention.allocate_kv_cache`) and writes them at the
+    positions `pos_L`, which is a tensor rather than a python int offset, so that a compiled AR stage never guards on (or specializes to) it
+    """
+    def __init__(self):
+        self.caching, self.max_L, self.merged_kv = False, 0, False
+        self.pos_L: Optional[torch.Tensor] = None   # L; the positions of the current tokens in the preallocated cache
+        self.slots: Dict[int, dict] = {}            # only used when max_L == 0
+    
+    def toggle(self, enable: bool, max_L: int = 0, merged_kv: bool = False):
+        self.caching = enable
+        self.max_L = max_L if enable else 0         # capacity of the preallocated kv cache (0: grow by torch.cat)
+        self.merged_kv = merged_kv and self.max_L > 0   # only supported by the preallocated cache
+        self.pos_L = None
+        self.slots.clear()
+    
+    def append(self, block_idx: int, k: torch.Tensor, v: torch.Tensor, dim_cat: int):  # only used when max_L == 0; returns k and v of all cached tokens
+        slot = self.slots.get(block_idx)
+        if slot is None: slot = self.slots[block_idx] = dict(k=k, v=v)
+        else: slot['k'] = torch.cat((slot['k'], k), dim=dim_cat); slot['v'] = torch.cat((slot['v'], v), dim=dim_cat)
+        return slot['k'], slot['v']
 
 
 class FFN(nn.Module):
@@ -80,40 +125,74 @@ class SelfAttention(nn.Module):
         self.using_flash = flash_if_available and flash_attn_func is not None
         self.using_xform = flash_if_available and memory_efficient_attention is not None
         
-        # only used during inference
-        self.caching, self.cached_k, self.cached_v = False, None, None
+        # only used during inference; VAR shares one KVCacheState among all its blocks
+        self.kv_cache = KVCacheState()
+        self.register_buffer('cached_kv', None, persistent=False)  # the preallocated kv cache, see `allocate_kv_cache`
+        self.cache_dim_cat = self.cache_kv_dim = 0
+    
+    def kv_caching(self, enable: bool, max_L: int = 0, merged_kv: bool = False):   # NOTE: affects every module sharing self.kv_cache
+        self.kv_cache.toggle(enable, max_L=max_L, merged_kv=merged_kv)
     
-    def kv_caching(self, enable: bool): self.caching, self.cached_k, self.cached_v = enable, None, None
+    def allocate_kv_cache(self, B: int, dtype: torch.dtype):   # only used in inference, called once before generation (see `VAR.kv_caching_scope`)
+        st = self.kv_cache
+        assert st.caching and st.max_L > 0, 'call kv_caching(True, max_L=...) first'
+        # the layout forward picks for the preallocated cache (flex_attention is never used in inference)
+        using_blhc = (self.using_flash and flash_attn_with_kvcache is not None and dtype != torch.float32) or self.using_xform
+        dim_cat = 1 if using_blhc else 2
+        shape = [B, st.max_L, self.num_heads, self.head_dim] if using_blhc else [B, self.num_heads, st.max_L, self.head_dim]
+        kv_dim = dim_cat+1 if st.merged_kv else 0   # merged: one BL2Hc or BHL2c tensor, so that k and v of the same token are adjacent
+        shape.insert(kv_dim, 2)
+        if self.cached_kv is None or list(self.cached_kv.shape) != shape or self.cached_kv.dtype != dtype:  # else reuse it, so recorded CUDA graphs stay valid
+            self.cached_kv = self.mat_qkv.weight.new_zeros(shape, dtype=dtype)  # zeros: the part not written yet is masked out, but must not be nan
+            if mark_static_address is not None: mark_static_address(self.cached_kv)
+        self.cache_dim_cat, self.cache_kv_dim = dim_cat, kv_dim
     
-    # NOTE: attn_bias is None during inference because kv cache is enabled
+    # NOTE: during inference with the preallocated kv cache, attn_bias masks out the part of the cache not written yet (see `VAR._infer_stage`)
+    # NOTE: attn_bias can also be a flex_attention BlockMask in training (see `VAR.block_mask`)
     def forward(self, x, attn_bias):
         B, L, C = x.shape
         
         qkv = F.linear(input=x, weight=self.mat_qkv.weight, bias=torch.cat((self.q_bias, self.zero_k_bias, self.v_bias))).view(B, L, 3, self.num_heads, self.head_dim)
         # qkv: BL3Hc
         
-        using_flash = self.using_flash and attn_bias is None and qkv.dtype != torch.float32
-        if using_flash or self.using_xform: q, k, v = qkv.unbind(dim=2); dim_cat = 1   # q or k or v: BLHc
+        st = self.kv_cache
+        using_static_cache = st.caching and st.max_L > 0    # flash_attn_with_kvcache masks by cache_seqlens, so attn_bias is not needed by flash then
+        if using_static_cache: using_flash = self.using_flash and flash_attn_with_kvcache is not None and qkv.dtype != torch.float32
+        else: using_flash = self.using_flash and attn_bias is None and qkv.dtype != torch.float32
+        using_flex = BlockMask is not None and isinstance(attn_bias, BlockMask)
+        using_blhc = using_flash or (self.using_xform and not using_flex)
+        if using_blhc: q, k, v = qkv.unbind(dim=2); dim_cat = 1                           # q or k or v: BLHc
         else: q, k, v = qkv.permute(2, 0, 3, 1, 4).unbind(dim=0); dim_cat = 2               # q or k or v: BHLc
         
         if self.cos_attn:
             scale_mul = self.scale_mul_1H11.clamp_max(self.max_scale_mul).exp()
-            if using_flash or self.using_xform: scale_mul = scale_mul.transpose(1, 2)  # 1H11 to 11H1
+            if using_blhc: scale_mul = scale_mul.transpose(1, 2)  # 1H11 to 11H1
             q = F.normalize(q, dim=-1).mul(scale_mul)
             k = F.normalize(k, dim=-1)
         
-        if self.caching:
-            if self.cached_k is None: self.cached_k = k; self.cached_v = v
-            else: k = self.cached_k = torch.cat((self.cached_k, k), dim=dim_cat); v = self.cached_v = torch.cat((self.cached_v, v), dim=dim_cat)
+        if using_static_cache:  # write k and v at st.pos_L in place and attend to the whole (fixed-size) cache, no python-side offset
+            assert dim_cat == self.cache_dim_cat, 'the kv cache was allocated for another layout'
+            k_cache, v_cache = self.cached_kv.unbind(self.cache_kv_dim)
+            k_cache.index_copy_(dim_cat, st.pos_L, k); v_cache.index_copy_(dim_cat, st.pos_L, v)
+            k, v = k_cache, v_cache
+        elif st.caching:
+            k, v = st.append(self.block_idx, k, v, dim_cat)
         
         dropout_p = self.attn_drop if self.training else 0.0
-        if using_flash:
+        if using_flash and using_static_cache:  # attend to the first pos_L[-1]+1 tokens of the cache, i.e., all the tokens written so far
+            oup = flash_attn_with_kvcache(q, k, v, cache_seqlens=(st.pos_L[-1:] + 1).int().expand(B).contiguous(), softmax_scale=self.scale).view(B, L, C)
+        elif using_flash:
             assert attn_bias is None and qkv.dtype != torch.float32
             oup = flash_attn_func(q, k, v, dropout_p=dropout_p, softmax_scale=self.scale).view(B, L, C)
+        elif using_flex:
+            assert dropout_p == 0, 'flex_attention does not support attention dropout'
+            oup = flex_attention(q, k, v, block_mask=attn_bias, scale=self.scale).transpose(1, 2).reshape(B, L, C)
         elif self.using_xform:
             oup = memory_efficient_attention(q, k, v, attn_bias=None if attn_bias is None else attn_bias.to(dtype=q.dtype).expand(B, self.num_heads, -1, -1), p=dropout_p, scale=self.scale).view(B, L, C)
         else:
-            oup = slow_attn(query=q, key=k, value=v, scale=self.scale, attn_mask=attn_bias, dropout_p=dropout_p).transpose(1, 2).reshape(B, L, C)
+            if attn_bias is not None: attn_bias = attn_bias.to(dtype=q.dtype)
+            with (sdpa_kernel(FUSED_SDPA_BACKENDS) if sdpa_kernel is not None and q.is_cuda else nullcontext()):
+                oup = slow_attn(query=q, key=k, value=v, scale=self.scale, attn_mask=attn_bias, dropout_p=dropout_p).transpose(1, 2).reshape(B, L, C)
         
         return self.proj_drop(self.proj(oup))
         # attn = (q @ k.transpose(-2, -1)).add_(attn_bias + self.local_rpb())  # BHLc @ BHcL => BHLL
@@ -146,7 +225,7 @@ class SABlock(nn.Module):
         else:
             self.gamma1 = self.gamma2 = 1
     
-    # NOTE: attn_bias is None during inference because kv cache is enabled
+    # NOTE: during inference attn_bias only masks out the part of the kv cache not written yet (see `SelfAttention.forward`)
     def forward(self, x, cond_BD, attn_bias):
         if self.fused_add_norm_fn is not None:
             return self.fused_forward_wo_cond(x, attn_bias=attn_bias)
@@ -155,7 +234,7 @@ class SABlock(nn.Module):
         x = x + self.drop_path(self.gamma2 * self.ffn(self.norm2(x.to(dtype=main_type))))               # following flash-attn: using fp32 in residual
         return x.to(dtype=main_type)
     
-    # NOTE: attn_bias is None during inference because kv cache is enabled
+    # NOTE: during inference attn_bias only masks out the part of the kv cache not written yet (see `SelfAttention.forward`)
     def fused_forward_wo_cond(self, x_and_residual, attn_bias):
         x, residual = (x_and_residual, None) if isinstance(x_and_residual, torch.Tensor) else x_and_residual
         rowscale1 = drop_path(x=x.new_ones(x.shape[:-1]), drop_prob=self.last_drop_p, training=True) if self.last_drop_p > 0 and self.training else None
@@ -179,7 +258,7 @@ class AdaLNSABlock(nn.Module):
     def __init__(
         self, block_idx, last_drop_p, embed_dim, cond_dim, shared_aln: bool, norm_layer,
         num_heads, mlp_ratio=4., drop=0., attn_drop=0., drop_path=0., tau=4, cos_attn=False,
-        flash_if_available=False, fused_if_available=True,
+        flash_if_available=False, fused_if_available=True, fused_aln_if_available=False,
     ):
         super(AdaLNSABlock, self).__init__()
         self.block_idx, self.last_drop_p, self.C = block_idx, last_drop_p, embed_dim
@@ -197,16 +276,21 @@ class AdaLNSABlock(nn.Module):
             self.ada_lin = nn.Sequential(nn.SiLU(inplace=False), lin)
         
         self.fused_add_norm_fn = None
+        self.using_fused_aln = fused_aln_if_available and ada_ln_modulate is not None   # opt-in; run `python -m models.fused_aln` to check its parity first
     
-    # NOTE: attn_bias is None during inference because kv cache is enabled
+    # NOTE: during inference attn_bias only masks out the part of the kv cache not written yet (see `SelfAttention.forward`)
     def forward(self, x, cond_BD, attn_bias):   # C: embed_dim, D: cond_dim
         if self.shared_aln:
             gamma1, gamma2, scale1, scale2, shift1, shift2 = (self.ada_gss + cond_BD).unbind(2) # 116C + B16C =unbind(2)=> 6 B1C
         else:
             gamma1, gamma2, scale1, scale2, shift1, shift2 = self.ada_lin(cond_BD).view(-1, 1, 6, self.C).unbind(2)
+        if self.using_fused_aln and x.is_cuda and not self.training and not torch.is_grad_enabled():   # the triton kernels have no backward
+            x_aln = ada_ln_modulate(x, scale1, shift1, eps=self.ln_wo_grad.eps)
+            x, x_aln = gate_residual_ada_ln_modulate(x, self.attn(x_aln, attn_bias=attn_bias), gamma1, scale2, shift2, eps=self.ln_wo_grad.eps)
+            return x + self.ffn(x_aln).mul(gamma2)
         x = x + self.drop_path(self.attn( self.ln_wo_grad(x).mul(scale1.add(1)).add_(shift1), attn_bias=attn_bias ).mul_(gamma1))
         x = x + self.drop_path(self.ffn( self.ln_wo_grad(x).mul(scale2.add(1)).add_(shift2) ).mul(gamma2)) # this mul(gamma2) cannot be in-placed when FusedMLP is used
         return x
     
     def extra_repr(self) -> str:
-        return f'shared_aln={self.shared_aln}'
+        return f'shared_aln={self.shared_aln}, using_fused_aln={self.using_fused_aln}'
@@ -0,0 +1,115 @@
+from typing import Tuple
+
+import torch
+import triton
+import triton.language as tl
+
+
+# this file only defines the fused (gate + residual +) LayerNorm + scale/shift ops used by AdaLNSABlock in inference
+__all__ = ['ada_ln_modulate', 'gate_residual_ada_ln_modulate',]
+
+
+@triton.jit
+def _ada_ln_modulate_fwd(
+    X, H, GATE, SCALE, SHIFT, X_OUT, Y,
+    L, C, stride_gate, stride_scale, stride_shift, eps,
+    HAS_RESIDUAL: tl.constexpr, BLOCK_C: tl.constexpr,
+):
+    row = tl.program_id(0)  # one program per token
+    b = row // L            # scale/shift/gate are shared by all the L tokens of a sample
+    cols = tl.arange(0, BLOCK_C)
+    mask = cols < C
+    x = tl.load(X + row * C + cols, mask=mask, other=0.).to(tl.float32)
+    if HAS_RESIDUAL:    # x = x + h * gate, done in fp32 like the residual stream of the blocks
+        h = tl.load(H + row * C + cols, mask=mask, other=0.).to(tl.float32)
+        g = tl.load(GATE + b * stride_gate + cols, mask=mask, other=0.).to(tl.float32)
+        x = x + h * g
+        tl.store(X_OUT + row * C + cols, x.to(X_OUT.dtype.element_ty), mask=mask)
+
+    mean = tl.sum(x, axis=0) / C
+    xc = tl.where(mask, x - mean, 0.)
+    rstd = 1 / tl.sqrt(tl.sum(xc * xc, axis=0) / C + eps)
+    scale = tl.load(SCALE + b * stride_scale + cols, mask=mask, other=0.).to(tl.float32)
+    shift = tl.load(SHIFT + b * stride_shift + cols, mask=mask, other=0.).to(tl.float32)
+    y = xc * rstd * (1 + scale) + shift
+    tl.store(Y + row * C + cols, y.to(Y.dtype.element_ty), mask=mask)
+
+
+def _batch_stride(t_B1C: torch.Tensor) -> int:
+    assert t_B1C.stride(-1) == 1, 'the last dim of scale/shift/gate should be contiguous'
+    return t_B1C.stride(0) if t_B1C.shape[0] > 1 else 0     # broadcast a (1, 1, C) tensor to all samples
+
+
+def _launch(x_BLC, h_BLC, gate_B1C, scale_B1C, shift_B1C, eps: float) -> Tuple[torch.Tensor, torch.Tensor]:
+    B, L, C = x_BLC.shape
+    x_BLC = x_BLC.contiguous()
+    has_residual = h_BLC is not None
+    if has_residual:
+        h_BLC = h_BLC.contiguous()
+        x_out = torch.empty_like(x_BLC)
+    else:
+        h_BLC = gate_B1C = x_out = x_BLC    # unused dummies
+    y = torch.empty_like(x_BLC)
+    _ada_ln_modulate_fwd[(B * L,)](
+        x_BLC, h_BLC, gate_B1C, scale_B1C, shift_B1C, x_out, y,
+        L, C, _batch_stride(gate_B1C), _batch_stride(scale_B1C), _batch_stride(shift_B1C), eps,
+        HAS_RESIDUAL=has_residual, BLOCK_C=triton.next_power_of_2(C),
+    )
+    return x_out, y
+
+
+def ada_ln_modulate(x_BLC: torch.Tensor, scale_B1C: torch.Tensor, shift_B1C: torch.Tensor, eps: float) -> torch.Tensor:
+    """
+    fused `LayerNorm(x, elementwise_affine=False) * (1 + scale) + shift`, forward only (no autograd)
+    """
+    return _launch(x_BLC, None, None, scale_B1C, shift_B1C, eps)[1]
+
+
+def gate_residual_ada_ln_modulate(
+    x_BLC: torch.Tensor, h_BLC: torch.Tensor, gate_B1C: torch.Tensor, scale_B1C: torch.Tensor, shift_B1C: torch.Tensor, eps: float,
+) -> Tuple[torch.Tensor, torch.Tensor]:
+    """
+    fused `x = x + h * gate; y = LayerNorm(x, elementwise_affine=False) * (1 + scale) + shift`, forward only (no autograd)
+    :return: the updated residual x and the modulated y
+    """
+    return _launch(x_BLC, h_BLC, gate_B1C, scale_B1C, shift_B1C, eps)
+
+
+if __name__ == '__main__':  # parity check against the eager AdaLNSABlock path: python -m models.fused_aln (needs a cuda device)
+    from functools import partial
+    import torch.nn as nn
+    from models.basic_var import AdaLNSABlock
+    
+    tol = {torch.float32: 1e-4, torch.float16: 1e-2, torch.bfloat16: 5e-2}
+    for dtype in (torch.float32, torch.float16, torch.bfloat16):
+        for B, B_cond in ((4, 4), (1, 1), (4, 1)):  # (4, 1): scale/shift/gate of batch 1 broadcast to all samples (`_batch_stride` returns 0)
+            torch.manual_seed(0)
+            C, L = 256, 37
+            x, h = torch.randn(B, L, C, device='cuda', dtype=dtype), torch.randn(B, L, C, device='cuda', dtype=dtype)
+            gamma1, scale1, shift1 = torch.randn(B_cond, 1, 6, C, device='cuda', dtype=dtype).unbind(2)[:3]    # strided B1C views, like in the blocks
+            ln = nn.LayerNorm(C, eps=1e-6, elementwise_affine=False)
+            with torch.no_grad():
+                ref_x = x + h * gamma1
+                ref_y = ln(ref_x).mul(scale1.add(1)).add_(shift1)
+                y = ada_ln_modulate(x, scale1, shift1, eps=1e-6)
+                out_x, out_y = gate_residual_ada_ln_modulate(x, h, gamma1, scale1, shift1, eps=1e-6)
+            for name, a, b in (('ada_ln_modulate', y, ln(x).mul(scale1.add(1)).add_(shift1)), ('residual', out_x, ref_x), ('gate_residual_ada_ln_modulate', out_y, ref_y)):
+                err = (a.float() - b.float()).abs().max().item()
+                assert err < tol[dtype] * max(1., b.float().abs().max().item()), f'{name}: {dtype=}, {B=}, {B_cond=}, max abs err={err:g}'
+        
+        for shared_aln in (False, True):    # the whole block, fused vs eager
+            torch.manual_seed(0)
+            B, C, D, L = 4, 256, 256, 37
+            block = AdaLNSABlock(
+                block_idx=0, last_drop_p=0, embed_dim=C, cond_dim=D, shared_aln=shared_aln, norm_layer=partial(nn.LayerNorm, eps=1e-6), num_heads=4,
+                fused_aln_if_available=True,
+            ).cuda().to(dtype).eval()
+            x = torch.randn(B, L, C, device='cuda', dtype=dtype)
+            cond = torch.randn(B, 1, 6, C, device='cuda', dtype=dtype) if shared_aln else torch.randn(B, D, device='cuda', dtype=dtype)
+            with torch.no_grad():
+                fused = block(x, cond, attn_bias=None)
+                block.using_fused_aln = False
+                eager = block(x, cond, attn_bias=None)
+            err = (fused.float() - eager.float()).abs().max().item()
+            assert err < tol[dtype] * max(1., eager.float().abs().max().item()), f'AdaLNSABlock: {dtype=}, {shared_aln=}, max abs err={err:g}'
+        print(f'[fused_aln] {dtype} parity OK', flush=True)
@@ -36,6 +36,17 @@ def gumbel_softmax_with_rng(logits: torch.Tensor, tau: float = 1, hard: bool = F
     return ret
 
 
+def get_autocast_dtype(x: torch.Tensor) -> torch.dtype:  # the dtype a matmul on x would produce, i.e., the autocast dtype if mixed precision is used, else x.dtype
+    dev = x.device.type
+    if hasattr(torch, 'get_autocast_dtype'):    # torch>=2.4
+        enabled, dtype = torch.is_autocast_enabled(dev), torch.get_autocast_dtype(dev)
+    elif dev == 'cpu':
+        enabled, dtype = torch.is_autocast_cpu_enabled(), torch.get_autocast_cpu_dtype()
+    else:
+        enabled, dtype = torch.is_autocast_enabled(), torch.get_autocast_gpu_dtype()
+    return dtype if enabled and x.is_floating_point() else x.dtype
+
+
 def drop_path(x, drop_prob: float = 0., training: bool = False, scale_by_keep: bool = True):    # taken from timm
     if drop_prob == 0. or not training: return x
     keep_prob = 1 - drop_prob
@@ -1,4 +1,5 @@
 import math
+from contextlib import contextmanager
 from functools import partial
 from typing import Optional, Tuple, Union
 
@@ -6,8 +7,8 @@ import torch
 import torch.nn as nn
 
 import dist
-from models.basic_var import AdaLNSABlock, SABlock
-from models.helpers import sample_with_top_k_top_p_, gumbel_softmax_with_rng
+from models.basic_var import AdaLNSABlock, KVCacheState, SABlock, create_block_mask
+from models.helpers import get_autocast_dtype, gumbel_softmax_with_rng, sample_with_top_k_top_p_
 from models.vqvae import VQVAE, VectorQuantizer2
 
 
@@ -24,7 +25,7 @@ class VAR(nn.Module):
         depth=16, embed_dim=1024, num_heads=16, mlp_ratio=4., drop_rate=0., attn_drop_rate=0., drop_path_rate=0.,
         layer_scale=-1., tau=4, cos_attn=False,
         patch_nums=(1, 2, 3, 4, 5, 6, 8, 10, 13, 16),   # 10 steps by default
-        flash_if_available=True, fused_if_available=True,
+        flash_if_available=True, fused_if_available=True, compile_if_available=False, merged_kv_cache=False, flex_if_available=False, fused_aln_if_available=False,
     ):
         super().__init__()
         # 0. hyperparameters
@@ -39,21 +40,24 @@ class VAR(nn.Module):
         self.prog_si = -1   # progressive training
         
         self.patch_nums: Tuple[int] = patch_nums
-        self.L = sum(pn ** 2 for pn in self.patch_nums)
         self.first_l = self.patch_nums[0] ** 2
         self.begin_ends = []
         cur = 0
         for i, pn in enumerate(self.patch_nums):
             self.begin_ends.append((cur, cur+pn ** 2))
             cur += pn ** 2
+        self.L = cur
         
         self.num_stages_minus_1 = len(self.patch_nums) - 1
+        self.merged_kv_cache = merged_kv_cache  # only used in inference: store k and v of each block in one tensor
         self.rng = torch.Generator(device=dist.get_device())
         
         # 1. input (word) embedding
         quant: VectorQuantizer2 = vae_local.quantize
         self.vae_proxy: Tuple[VQVAE] = (vae_local,)
         self.vae_quant_proxy: Tuple[VectorQuantizer2] = (quant,)
+        self.vae_embed_CV: Optional[torch.Tensor] = None    # channel-first codebook, cached for inference (see `get_vae_embed_CV`)
+        self.vae_embed_key: Tuple[int, ...] = ()
         self.word_embed = nn.Linear(self.Cvae, self.C)
         
         # 2. class embedding
@@ -66,13 +70,8 @@ class VAR(nn.Module):
         nn.init.trunc_normal_(self.pos_start.data, mean=0, std=init_std)
         
         # 3. absolute position embedding
-        pos_1LC = []
-        for i, pn in enumerate(self.patch_nums):
-            pe = torch.empty(1, pn*pn, self.C)
-            nn.init.trunc_normal_(pe, mean=0, std=init_std)
-            pos_1LC.append(pe)
-        pos_1LC = torch.cat(pos_1LC, dim=1)     # 1, L, C
-        assert tuple(pos_1LC.shape) == (1, self.L, self.C)
+        pos_1LC = torch.empty(1, self.L, self.C)    # all levels share the same init, so initialize them at once
+        nn.init.trunc_normal_(pos_1LC, mean=0, std=init_std)
         self.pos_1LC = nn.Parameter(pos_1LC)
         # level embedding (similar to GPT's segment embedding, used to distinguish different levels of token pyramid)
         self.lvl_embed = nn.Embedding(len(self.patch_nums), self.C)
@@ -83,14 +82,14 @@ class VAR(nn.Module):
         
         norm_layer = partial(nn.LayerNorm, eps=norm_eps)
         self.drop_path_rate = drop_path_rate
-        dpr = [x.item() for x in torch.linspace(0, drop_path_rate, depth)]  # stochastic depth decay rule (linearly increasing)
+        dpr = [drop_path_rate * i / (depth-1) for i in range(depth)] if depth > 1 else [0.] * depth   # stochastic depth decay rule (linearly increasing)
         self.blocks = nn.ModuleList([
             AdaLNSABlock(
                 cond_dim=self.D, shared_aln=shared_aln,
                 block_idx=block_idx, embed_dim=self.C, norm_layer=norm_layer, num_heads=num_heads, mlp_ratio=mlp_ratio,
                 drop=drop_rate, attn_drop=attn_drop_rate, drop_path=dpr[block_idx], last_drop_p=0 if block_idx == 0 else dpr[block_idx-1],
                 tau=tau, cos_attn=cos_attn,
-                flash_if_available=flash_if_available, fused_if_available=fused_if_available,
+                flash_if_available=flash_if_available, fused_if_available=fused_if_available, fused_aln_if_available=fused_aln_if_available,
             ) if self.using_aln else SABlock(
                 layer_scale=layer_scale,
                 block_idx=block_idx, embed_dim=self.C, norm_layer=norm_layer, num_heads=num_heads, mlp_ratio=mlp_ratio,
@@ -100,29 +99,43 @@ class VAR(nn.Module):
             )
             for block_idx in range(depth)
         ])
+        self.kv_cache = KVCacheState()  # shared by all blocks, see `kv_caching_scope`
+        for b in self.blocks: b.attn.kv_cache = self.kv_cache
         
         if self.blocks[-1].fused_add_norm_fn is not None:
             self.gamma2_last = nn.Parameter(self.layer_scale * torch.ones(embed_dim), requires_grad=True) if self.layer_scale >= 0 else 1
         else:
             self.gamma2_last = None
         
-        fused_add_norm_fns = [b.fused_add_norm_fn is not None for b in self.blocks]
-        self.using_fused_add_norm_fn = any(fused_add_norm_fns)
+        num_flash = num_fused_add_ln = num_fused_mlp = 0  # counted in a single pass over the blocks
+        for b in self.blocks:
+            num_flash += b.attn.using_flash; num_fused_add_ln += b.fused_add_norm_fn is not None; num_fused_mlp += b.ffn.fused_mlp_func is not None
+        self.using_fused_add_norm_fn = num_fused_add_ln > 0
         print(
-            f'\n[constructor]  ==== flash_if_available={flash_if_available} ({sum(b.attn.using_flash for b in self.blocks)}/{self.depth}), fused_if_available={fused_if_available} (fusing_add_ln={sum(fused_add_norm_fns)}/{self.depth}, fusing_mlp={sum(b.ffn.fused_mlp_func is not None for b in self.blocks)}/{self.depth}) ==== \n'
+            f'\n[constructor]  ==== flash_if_available={flash_if_available} ({num_flash}/{self.depth}), fused_if_available={fused_if_available} (fusing_add_ln={num_fused_add_ln}/{self.depth}, fusing_mlp={num_fused_mlp}/{self.depth}) ==== \n'
             f'    [vGPT config ] embed_dim={embed_dim}, num_heads={num_heads}, depth={depth}, mlp_ratio={mlp_ratio}\n'
-            f'    [drop ratios ] drop_rate={drop_rate}, attn_drop_rate={attn_drop_rate}, drop_path_rate={drop_path_rate:g} ({torch.linspace(0, drop_path_rate, depth)})',
+            f'    [drop ratios ] drop_rate={drop_rate}, attn_drop_rate={attn_drop_rate}, drop_path_rate={drop_path_rate:g} ([{", ".join(f"{p:.4f}" for p in dpr)}])',
             end='\n\n', flush=True
         )
         
         # 5. attention mask used in training (for masking out the future)
-        #    it won't be used in inference, since kv cache is enabled
+        #    in inference, its rows of the current stage mask out the part of the kv cache not written yet (see `_infer_stage`)
         d: torch.Tensor = torch.cat([torch.full((pn*pn,), i) for i, pn in enumerate(self.patch_nums)]).view(1, self.L, 1)
         dT = d.transpose(1, 2)    # dT: 11L
         lvl_1L = dT[:, 0].contiguous()
         self.register_buffer('lvl_1L', lvl_1L)
         attn_bias_for_masking = torch.where(d >= dT, 0., -torch.inf).reshape(1, 1, self.L, self.L)
         self.register_buffer('attn_bias_for_masking', attn_bias_for_masking.contiguous())
+        # the mask above is block-causal (a token sees all tokens of its own and previous levels), so with flex_attention it can be
+        # represented by a compact BlockMask that is built only once here; flex_attention has no attention dropout though
+        self.using_flex = flex_if_available and create_block_mask is not None and attn_drop_rate == 0
+        self.block_mask = None
+        if self.using_flex:
+            lvl_L = lvl_1L[0].to(dist.get_device())
+            self.block_mask = create_block_mask(lambda b, h, q_idx, kv_idx: lvl_L[q_idx] >= lvl_L[kv_idx], B=None, H=None, Q_LEN=self.L, KV_LEN=self.L, device=dist.get_device())
+        # lvl_embed(lvl_1L) + pos_1LC only depends on parameters, so it is cached for inference (see `get_lvl_pos`)
+        self.register_buffer('lvl_pos', None, persistent=False)
+        self.lvl_pos_key: Tuple[int, ...] = ()  # identifies the parameters lvl_pos was computed from
         
         # 6. classifier head
         if self.using_aln:
@@ -131,30 +144,104 @@ class VAR(nn.Module):
         else:
             self.head_nm = MultiInpIdentity()
             self.head = nn.Sequential(norm_layer(self.C), nn.Linear(self.C, self.V))
+        
+        # 7. torch.compile (optional), to get rid of the per-op python/cuda dispatch overhead and fuse small elementwise ops;
+        #    dynamic=True so that the different sequence lengths of different stages won't trigger recompilation
+        self.compile_if_available = compile_if_available and hasattr(torch, 'compile')
+        maybe_compile = partial(torch.compile, dynamic=True) if self.compile_if_available else lambda fn, **kwargs: fn
+        self.init_first_token_map = maybe_compile(self._init_first_token_map)
+        self.embed_teacher_forcing_input = maybe_compile(self._embed_teacher_forcing_input)
+        # one AR stage (block stack + head) as one graph, replayed with CUDA graphs by 'reduce-overhead'; the kv caches are fixed buffers written
+        # in place at tensor positions (see `KVCacheState`), so the stages only differ by the (symbolic) sequence length
+        self.infer_stage = maybe_compile(self._infer_stage, mode='reduce-overhead')
+    
+    def get_lvl_pos(self) -> torch.Tensor:    # 1LC
+        if self.training:   # parameters are being updated, so never cache
+            return self.lvl_embed(self.lvl_1L) + self.pos_1LC
+        # the version counters catch in-place updates (e.g., `p.copy_` of an EMA swap, optimizer steps), the data pointers catch replaced
+        # parameters (e.g., `.to()`, `load_state_dict(assign=True)`); writes through `p.data` bypass both, so call `.eval()` after them
+        key = tuple(x for p in (self.pos_1LC, self.lvl_embed.weight) for x in (p.data_ptr(), p._version))
+        if self.lvl_pos is None or key != self.lvl_pos_key:
+            with torch.no_grad():
+                self.lvl_pos = self.lvl_embed(self.lvl_1L) + self.pos_1LC
+            self.lvl_pos_key = key
+        return self.lvl_pos
+    
+    def get_vae_embed_CV(self) -> torch.Tensor:  # CV, to gather h_BChw directly in its channel-first layout
+        # the VAE is not a submodule, so its loads never reach `_load_from_state_dict`; the key (as in `get_lvl_pos`) catches them instead
+        w = self.vae_quant_proxy[0].embedding.weight
+        key = (w.data_ptr(), w._version)
+        if self.vae_embed_CV is None or key != self.vae_embed_key:
+            self.vae_embed_CV, self.vae_embed_key = w.detach().t().contiguous(), key
+        return self.vae_embed_CV
+    
+    def train(self, mode: bool = True):
+        self.lvl_pos = self.vae_embed_CV = None     # invalidate the cached level+position embedding and codebook
+        return super().train(mode)
+    
+    def _load_from_state_dict(self, *args, **kwargs):
+        self.lvl_pos = None     # invalidate the cached level+position embedding; unlike `load_state_dict`, this is also reached via a parent module
+        return super()._load_from_state_dict(*args, **kwargs)
     
-    def get_logits(self, h_or_h_and_residual: Union[torch.Tensor, Tuple[torch.Tensor, torch.Tensor]], cond_BD: Optional[torch.Tensor]):
+    def _init_first_token_map(self, sos: torch.Tensor, lvl_pos: torch.Tensor) -> torch.Tensor:
+        B2 = sos.shape[0]   # 2B due to CFG (or B if cfg == 0)
+        return sos.unsqueeze(1).expand(B2, self.first_l, -1) + self.pos_start.expand(B2, self.first_l, -1) + lvl_pos[:, :self.first_l]
+    
+    def _embed_teacher_forcing_input(self, cond_BD: torch.Tensor, x_BLCv_wo_first_l: torch.Tensor, ed: int) -> torch.Tensor:
+        B = cond_BD.shape[0]
+        sos = cond_BD.unsqueeze(1).expand(B, self.first_l, -1) + self.pos_start.expand(B, self.first_l, -1)
+        if self.prog_si == 0: x_BLC = sos
+        else: x_BLC = torch.cat((sos, self.word_embed(x_BLCv_wo_first_l.float())), dim=1)
+        return x_BLC + self.lvl_embed(self.lvl_1L[:, :ed].expand(B, -1)) + self.pos_1LC[:, :ed]   # lvl: BLC;  pos: 1LC
+    
+    @contextmanager
+    def kv_caching_scope(self, B: int, dtype: torch.dtype):  # only used in inference; the kv caches of all blocks are allocated up front to hold all the self.L tokens
+        self.kv_cache.toggle(True, max_L=self.L, merged_kv=self.merged_kv_cache)
+        try:
+            for b in self.blocks: b.attn.allocate_kv_cache(B, dtype)
+            yield
+        finally:
+            self.kv_cache.toggle(False)
+            if not self.compile_if_available:   # else keep the buffers for the next call, since the CUDA graphs of `infer_stage` are recorded on them
+                for b in self.blocks: b.attn.cached_kv = None
+    
+    def _run_blocks(self, x: torch.Tensor, cond_BD_or_gss: torch.Tensor, attn_bias: Optional[torch.Tensor]):
+        for b in self.blocks:
+            x = b(x=x, cond_BD=cond_BD_or_gss, attn_bias=attn_bias)
+        return x
+    
+    def _infer_stage(self, x: torch.Tensor, cond_BD_or_gss: torch.Tensor, cond_BD: torch.Tensor, fp32: bool) -> torch.Tensor:   # only used in inference
+        # the tokens of this stage see all the tokens of their own and previous stages, i.e., the part of the kv cache written so far
+        attn_bias = self.attn_bias_for_masking[:, :, self.kv_cache.pos_L]   # 11L(self.L)
+        return self.get_logits(self._run_blocks(x, cond_BD_or_gss, attn_bias), cond_BD, fp32=fp32)
+    
+    def get_logits(self, h_or_h_and_residual: Union[torch.Tensor, Tuple[torch.Tensor, torch.Tensor]], cond_BD: Optional[torch.Tensor], fp32=True):
         if not isinstance(h_or_h_and_residual, torch.Tensor):
             h, resi = h_or_h_and_residual   # is h_and_residual, so fused_add_norm must be used, so self.gamma2_last is not None
             h = resi + self.gamma2_last * self.blocks[-1].drop_path(h)
         else:   # is h, so fused_add_norm is not used, and self.gamma2_last is None
             h = h_or_h_and_residual
+        if not fp32:    # keep the dtype of h (e.g., bf16 in half-precision inference)
+            return self.head(self.head_nm(h, cond_BD))
         return self.head(self.head_nm(h.float(), cond_BD).float()).float()
     
     @torch.no_grad()
     def autoregressive_infer_cfg(
         self, B: int, label_B: Optional[Union[int, torch.LongTensor]],
         g_seed: Optional[int] = None, cfg=1.5, top_k=0, top_p=0.0,
-        more_smooth=False,
+        more_smooth=False, dtype: Optional[torch.dtype] = None,
     ) -> torch.Tensor:   # returns reconstructed image (B, 3, H, W) in [0, 1]
         """
         only used for inference, on autoregressive mode
         :param B: batch size
         :param label_B: imagenet label; if None, randomly sampled
         :param g_seed: random seed
-        :param cfg: classifier-free guidance ratio
+        :param cfg: classifier-free guidance ratio; if 0, the unconditional batch is skipped
         :param top_k: top-k sampling
         :param top_p: top-p sampling
         :param more_smooth: smoothing the pred using gumbel softmax; only used in visualization, not used in FID/IS benchmarking
+        :param dtype: if given (e.g., torch.bfloat16), run the transformer and the head in this dtype without upcasting to fp32 (only the
+                      guided logits are upcast for sampling); the weights should be in this dtype too, via `var.to(dtype)` or autocast
         :return: if returns_vemb: list of embedding h_BChw := vae_embed(idx_Bl), else: list of idx_Bl
         """
         if g_seed is None: rng = None
@@ -165,45 +252,55 @@ class VAR(nn.Module):
         elif isinstance(label_B, int):
             label_B = torch.full((B,), fill_value=self.num_classes if label_B < 0 else label_B, device=self.lvl_1L.device)
         
-        sos = cond_BD = self.class_emb(torch.cat((label_B, torch.full_like(label_B, fill_value=self.num_classes)), dim=0))
+        using_cfg = cfg != 0    # if cfg == 0, the unconditional half of the batch would never be used, so don't compute it at all
+        sos = cond_BD = self.class_emb(label_B)
+        if using_cfg:   # append the unconditional embedding (the last row of class_emb) in embedding space, no need to gather it B times
+            sos = cond_BD = torch.cat((cond_BD, self.class_emb.weight[self.num_classes].expand(B, -1)), dim=0)
         
-        lvl_pos = self.lvl_embed(self.lvl_1L) + self.pos_1LC
-        next_token_map = sos.unsqueeze(1).expand(2 * B, self.first_l, -1) + self.pos_start.expand(2 * B, self.first_l, -1) + lvl_pos[:, :self.first_l]
+        lvl_pos = self.get_lvl_pos()
+        if dtype is not None: sos, cond_BD, lvl_pos = sos.to(dtype), cond_BD.to(dtype), lvl_pos.to(dtype)
+        next_token_map = self.init_first_token_map(sos, lvl_pos)
         
         cur_L = 0
-        f_hat = sos.new_zeros(B, self.Cvae, self.patch_nums[-1], self.patch_nums[-1])
+        f_hat = sos.new_zeros(B, self.Cvae, self.patch_nums[-1], self.patch_nums[-1], dtype=self.vae_quant_proxy[0].embedding.weight.dtype)
+        cond_BD_or_gss = self.shared_ada_lin(cond_BD)   # cond_BD is fixed across stages, so only compute it once
+        vae_embed_CV = self.get_vae_embed_CV()  # channel-first codebook, transposed once rather than on every call
         
-        for b in self.blocks: b.attn.kv_caching(True)
-        for si, pn in enumerate(self.patch_nums):   # si: i-th segment
-            ratio = si / self.num_stages_minus_1
-            # last_L = cur_L
-            cur_L += pn*pn
-            # assert self.attn_bias_for_masking[:, :, last_L:cur_L, :cur_L].sum() == 0, f'AR with {(self.attn_bias_for_masking[:, :, last_L:cur_L, :cur_L] != 0).sum()} / {self.attn_bias_for_masking[:, :, last_L:cur_L, :cur_L].numel()} mask item'
-            cond_BD_or_gss = self.shared_ada_lin(cond_BD)
-            SABlock.forward
-            x = next_token_map
-            for b in self.blocks:
-                x = b(x=x, cond_BD=cond_BD_or_gss, attn_bias=None)
-            logits_BlV = self.get_logits(x, cond_BD)
-            
-            t = cfg * ratio
-            logits_BlV = (1+t) * logits_BlV[:B] - t * logits_BlV[B:]
-            
-            idx_Bl = sample_with_top_k_top_p_(logits_BlV, rng=rng, top_k=top_k, top_p=top_p, num_samples=1)[:, :, 0]
-            if not more_smooth:
-                h_BChw = self.vae_quant_proxy[0].embedding(idx_Bl)   # B, l, Cvae
-            else:
-                gum_t = max(0.27 * (1 - ratio * 0.95), 0.005)   # refer to mask-git
-                h_BChw = gumbel_softmax_with_rng(logits_BlV.mul(1 + ratio), tau=gum_t, hard=False, dim=-1, rng=rng) @ self.vae_quant_proxy[0].embedding.weight.unsqueeze(0)
-            
-            h_BChw = h_BChw.transpose_(1, 2).reshape(B, self.Cvae, pn, pn)
-            f_hat, next_token_map = self.vae_quant_proxy[0].get_next_autoregressive_input(si, len(self.patch_nums), f_hat, h_BChw)
-            if si != self.num_stages_minus_1:   # prepare for next stage
-                next_token_map = next_token_map.view(B, self.Cvae, -1).transpose(1, 2)
-                next_token_map = self.word_embed(next_token_map) + lvl_pos[:, cur_L:cur_L + self.patch_nums[si+1] ** 2]
-                next_token_map = next_token_map.repeat(2, 1, 1)   # double the batch sizes due to CFG
+        # k and v have the dtype of the qkv matmul: the autocast dtype if mixed precision is used, else the dtype of the weights
+        with self.kv_caching_scope(sos.shape[0], get_autocast_dtype(self.blocks[0].attn.mat_qkv.weight)):
+            for si, pn in enumerate(self.patch_nums):   # si: i-th segment
+                ratio = si / self.num_stages_minus_1
+                # last_L = cur_L
+                cur_L += pn*pn
+                # assert self.attn_bias_for_masking[:, :, last_L:cur_L, :cur_L].sum() == 0, f'AR with {(self.attn_bias_for_masking[:, :, last_L:cur_L, :cur_L] != 0).sum()} / {self.attn_bias_for_masking[:, :, last_L:cur_L, :cur_L].numel()} mask item'
+                self.kv_cache.pos_L = torch.arange(cur_L - pn*pn, cur_L, device=f_hat.device)    # where the kv of this stage goes in the cache
+                # blocks: see SABlock.forward / AdaLNSABlock.forward
+                logits_BlV = self.infer_stage(next_token_map, cond_BD_or_gss, cond_BD, fp32=dtype is None)
+                
+                if using_cfg:
+                    t = cfg * ratio
+                    logits_BlV = torch.lerp(logits_BlV[B:], logits_BlV[:B], 1+t)  # == (1+t) * logits_BlV[:B] - t * logits_BlV[B:], in one kernel
+                if dtype is not None: logits_BlV = logits_BlV.float()  # top-k/top-p and softmax in fp32
+                
+                idx_Bl = sample_with_top_k_top_p_(logits_BlV, rng=rng, top_k=top_k, top_p=top_p, num_samples=1)[:, :, 0]
+                if not more_smooth:
+                    h_BCl = vae_embed_CV.unsqueeze(0).expand(B, -1, -1).gather(2, idx_Bl.unsqueeze(1).expand(-1, self.Cvae, -1))   # B, Cvae, l
+                else:
+                    gum_t = max(0.27 * (1 - ratio * 0.95), 0.005)   # refer to mask-git
+                    h_BCl = vae_embed_CV @ gumbel_softmax_with_rng(logits_BlV.mul(1 + ratio), tau=gum_t, hard=False, dim=-1, rng=rng).transpose(1, 2)  # CV @ BVl => BCl
+                
+                h_BChw = h_BCl.view(B, self.Cvae, pn, pn)   # no transpose copy needed since h_BCl is already channel-first
+                f_hat, next_token_map = self.vae_quant_proxy[0].get_next_autoregressive_input(si, len(self.patch_nums), f_hat, h_BChw)
+                if si != self.num_stages_minus_1:   # prepare for next stage
+                    next_token_map = next_token_map.view(B, self.Cvae, -1).transpose(1, 2)
+                    if dtype is not None: next_token_map = next_token_map.to(dtype)
+                    bg, ed = self.begin_ends[si+1]
+                    next_token_map = self.word_embed(next_token_map)
+                    if using_cfg:   # double the batch sizes due to CFG: the broadcasted add writes both halves at once, no extra .repeat copy
+                        next_token_map = torch.add(next_token_map.unsqueeze(0).expand(2, -1, -1, -1), lvl_pos[:, bg:ed]).view(2 * B, ed - bg, self.C)
+                    else:
+                        next_token_map = next_token_map + lvl_pos[:, bg:ed]
         
-        for b in self.blocks: b.attn.kv_caching(False)
         return self.vae_proxy[0].fhat_to_img(f_hat).add_(1).mul_(0.5)   # de-normalize, from [-1, 1] to [0, 1]
     
     def forward(self, label_B: torch.LongTensor, x_BLCv_wo_first_l: torch.Tensor) -> torch.Tensor:  # returns logits_BLV
@@ -216,25 +313,19 @@ class VAR(nn.Module):
         B = x_BLCv_wo_first_l.shape[0]
         with torch.cuda.amp.autocast(enabled=False):
             label_B = torch.where(torch.rand(B, device=label_B.device) < self.cond_drop_rate, self.num_classes, label_B)
-            sos = cond_BD = self.class_emb(label_B)
-            sos = sos.unsqueeze(1).expand(B, self.first_l, -1) + self.pos_start.expand(B, self.first_l, -1)
-            
-            if self.prog_si == 0: x_BLC = sos
-            else: x_BLC = torch.cat((sos, self.word_embed(x_BLCv_wo_first_l.float())), dim=1)
-            x_BLC += self.lvl_embed(self.lvl_1L[:, :ed].expand(B, -1)) + self.pos_1LC[:, :ed] # lvl: BLC;  pos: 1LC
+            cond_BD = self.class_emb(label_B)
+            x_BLC = self.embed_teacher_forcing_input(cond_BD, x_BLCv_wo_first_l, ed)
         
-        attn_bias = self.attn_bias_for_masking[:, :, :ed, :ed]
+        attn_bias = self.block_mask if self.using_flex and ed == self.L else self.attn_bias_for_masking[:, :, :ed, :ed]
         cond_BD_or_gss = self.shared_ada_lin(cond_BD)
         
-        # hack: get the dtype if mixed precision is used
-        temp = x_BLC.new_ones(8, 8)
-        main_type = torch.matmul(temp, temp).dtype
+        main_type = get_autocast_dtype(x_BLC)    # get the dtype if mixed precision is used
         
         x_BLC = x_BLC.to(dtype=main_type)
         cond_BD_or_gss = cond_BD_or_gss.to(dtype=main_type)
-        attn_bias = attn_bias.to(dtype=main_type)
+        if isinstance(attn_bias, torch.Tensor): attn_bias = attn_bias.to(dtype=main_type)
         
-        SABlock.forward, AdaLNSABlock.forward
+        # blocks: see SABlock.forward / AdaLNSABlock.forward
         for i, b in enumerate(self.blocks):
             x_BLC = b(x=x_BLC, cond_BD=cond_BD_or_gss, attn_bias=attn_bias)
         x_BLC = self.get_logits(x_BLC.float(), cond_BD)
@@ -286,7 +377,7 @@ class VAR(nn.Module):
         gamma2_last = self.gamma2_last
         if isinstance(gamma2_last, nn.Parameter):
             gamma2_last = f'<vector {self.layer_scale}>'
-        return f'drop_path_rate={self.drop_path_rate:g}, layer_scale={self.layer_scale:g}, gamma2_last={gamma2_last}'
+        return f'drop_path_rate={self.drop_path_rate:g}, layer_scale={self.layer_scale:g}, gamma2_last={gamma2_last}, compile_if_available={self.compile_if_available}, merged_kv_cache={self.merged_kv_cache}, using_flex={self.using_flex}'
 
 
 class AdaLNBeforeHead(nn.Module):